@@ -8,6 +8,11 @@ import datetime
 import json
 import logging
 import os
+import tempfile
+import threading
+import time
+from collections.abc import Callable
+from pathlib import Path
 from zoneinfo import ZoneInfo
 
 import controlmyspa
@@ -15,20 +20,100 @@ import flask
 import requests
 import sentry_sdk
 import tenacity
+from apscheduler.executors.pool import ThreadPoolExecutor
 from apscheduler.schedulers.background import BackgroundScheduler
 from dotenv import load_dotenv
 from flask_caching import Cache
+from requests.adapters import HTTPAdapter, Retry
 from sentry_sdk.integrations.flask import FlaskIntegration
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+load_dotenv()
+# read once at startup, changes to the environment need an application restart.
+# TEMP_LOW and TEMP_HIGH are required, fail on startup instead of heating to 0
+CONFIG = {
+    "TEMP_LOW": int(os.environ["TEMP_LOW"]),
+    "TEMP_HIGH": int(os.environ["TEMP_HIGH"]),
+    "TEMP_OVERRIDE": int(os.getenv("TEMP_OVERRIDE", "0")),
+    "USER": os.getenv("CONTROLMYSPA_USER"),
+    "PASS": os.getenv("CONTROLMYSPA_PASS"),
+}
+
+
+def _default_cache_dir() -> str:
+    """Return a private per-user cache directory in the system temp dir.
+
+    The cache entries are unpickled on read, so refuse to use a directory that
+    somebody else created or that other users can write to.
+    """
+    path = Path(tempfile.gettempdir()) / f"controlmyspa-porssari-{os.getuid()}"
+    path.mkdir(mode=0o700, exist_ok=True)
+    stat = path.lstat()
+    if path.is_symlink() or stat.st_uid != os.getuid() or stat.st_mode & 0o077:
+        msg = f"refusing to use insecure cache directory {path}"
+        raise RuntimeError(msg)
+    return str(path)
+
+
 APP = flask.Flask(__name__)
-cache = Cache(APP, config={"CACHE_TYPE": "SimpleCache"})
-scheduler = BackgroundScheduler()
+# file based so that multiple worker processes share the cached pool temperatures
+# and their 15 minute TTL. concurrent cache misses are only serialized within one
+# process by _pool_lock
+cache = Cache(
+    APP,
+    config={
+        "CACHE_TYPE": "FileSystemCache",
+        "CACHE_DIR": os.getenv("CACHE_DIR") or _default_cache_dir(),
+    },
+)
+# a single worker thread is enough for the quarter-hourly job
+scheduler = BackgroundScheduler(
+    executors={"default": ThreadPoolExecutor(max_workers=1)}
+)
 PORSSARI_API = "https://api.porssari.fi/getcontrols.php"
+HELSINKI = ZoneInfo("Europe/Helsinki")
+UTC = datetime.UTC
+# marks the manual override timer as not set
+_EPOCH = datetime.datetime.fromtimestamp(0, tz=UTC)
+# (quarter-hour bucket, Helsinki hour) of the last current_hour() call
+_hour_cache = (None, None)
 porssari_config = {}
+# porssari_config["Channel1"] resolved to the temperature to set for each hour
+_HOUR_TO_TEMP = []
+# the temperature set_temp() last successfully applied
+_last_commanded_temp = None
+# pool temperatures set_temp() last read from the API and when (time.monotonic())
+_last_pool = None
+_last_pool_read = 0.0
+# re-read the pool temperatures in set_temp() on every second 15 minute run even
+# if the target temperature did not change, to detect manual overrides
+POOL_REFRESH_INTERVAL = 25 * 60
+
+# shared HTTP connection pool to reuse TCP+TLS connections between requests,
+# connection errors and server errors are retried on the pooled connections
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=("GET",),
+        ),
+    ),
+)
 
-# set to datetime.datetime.now() to disable manual override on startup
-manual_override_endtime = datetime.datetime.fromtimestamp(0)
+# the controlmyspa client logs in on construction, keep one instance per process
+_spa_client = None
+_spa_lock = threading.Lock()
+# serializes cache misses of the pool temperatures
+_pool_lock = threading.Lock()
+
+# set to datetime.datetime.now(UTC) to disable manual override on startup
+manual_override_endtime = _EPOCH
 
 """
 Example porssari.fi config:
@@ -101,7 +186,7 @@ And another example across midnight:
 
 
 def initialize():
-    """Initialize scheduled jobs and run the control loop."""
+    """Initialize the scheduled job and run the control loop."""
     scheduler.start()
     scheduler.add_job(
         control,
@@ -111,17 +196,122 @@ def initialize():
         misfire_grace_time=None,
         coalesce=True,
         max_instances=1,
+        next_run_time=datetime.datetime.now(UTC),
     )
-    scheduler.add_job(
-        update_porssari,
-        "interval",
-        minutes=15,
-        id="update_porssari",
-        misfire_grace_time=None,
-        coalesce=True,
-        max_instances=1,
-        next_run_time=datetime.datetime.now(),
-    )
+
+
+def _is_unauthorized(exception: requests.exceptions.HTTPError) -> bool:
+    """Check whether the controlmyspa API rejected the access token."""
+    status_code = getattr(exception.response, "status_code", None)
+    return status_code == requests.codes.unauthorized
+
+
+def get_spa(*, refresh: bool = True) -> controlmyspa.ControlMySpa:
+    """Return the shared, logged in ControlMySpa client.
+
+    The controlmyspa module does not accept a requests session, so we keep the
+    client object itself to only pay for the login once per process and log in
+    again when the access token has expired. With refresh=False an existing
+    client is returned without re-fetching the pool state.
+    """
+    global _spa_client  # noqa: PLW0603
+    with _spa_lock:
+        if _spa_client is not None and not refresh:
+            return _spa_client
+        if _spa_client is not None:
+            try:
+                # the client only fetches the pool state on login, refresh it
+                _spa_client._get_info()  # noqa: SLF001
+            except requests.exceptions.HTTPError as exception:
+                if not _is_unauthorized(exception):
+                    raise
+                # the access token expired, log in again below
+                APP.logger.info("controlmyspa token expired, logging in again")
+                _spa_client = None
+            else:
+                return _spa_client
+        _spa_client = controlmyspa.ControlMySpa(CONFIG["USER"], CONFIG["PASS"])
+        return _spa_client
+
+
+@cache.memoize(timeout=15 * 60)
+def _fetch_pool() -> dict:
+    """Fetch the current and desired pool temperatures."""
+    api = get_spa()
+    return {
+        "desired_temp": api.desired_temp,
+        "current_temp": api.current_temp,
+    }
+
+
+def _cache_pool(pool: dict) -> None:
+    """Store freshly fetched pool temperatures as the cached _fetch_pool() result."""
+    cache.set(_fetch_pool.make_cache_key(_fetch_pool.uncached), pool, timeout=15 * 60)
+
+
+def _refresh_pool() -> dict:
+    """Fetch the pool temperatures from the API, bypassing and updating the cache."""
+    pool = _fetch_pool.uncached()
+    _cache_pool(pool)
+    return pool
+
+
+def _write_desired_temp(temp: int) -> dict:
+    """Set the desired pool temperature and cache the resulting pool state."""
+    global _spa_client  # noqa: PLW0603
+    # the controlmyspa setter re-fetches the pool state after the change itself
+    api = get_spa(refresh=False)
+    try:
+        api.desired_temp = temp
+    except requests.exceptions.HTTPError as exception:
+        if _is_unauthorized(exception):
+            # the access token expired, log in again on the next attempt
+            with _spa_lock:
+                _spa_client = None
+        raise
+    pool = {
+        "desired_temp": api.desired_temp,
+        "current_temp": api.current_temp,
+    }
+    _cache_pool(pool)
+    return pool
+
+
+def _with_retry[T](fn: Callable[..., T], *args: object) -> T:
+    """Call fn, retrying controlmyspa API errors with an exponential backoff.
+
+    Raises tenacity.RetryError if all attempts failed.
+    """
+    return tenacity.Retrying(
+        retry=tenacity.retry_if_exception_type(requests.exceptions.RequestException),
+        wait=tenacity.wait_random_exponential(multiplier=1, max=60),
+        stop=tenacity.stop_after_attempt(5),
+        before_sleep=tenacity.before_sleep_log(APP.logger, logging.INFO),
+    )(fn, *args)
+
+
+def get_pool() -> dict:
+    """Return the pool temperatures, cached for 15 minutes.
+
+    Concurrent cache misses wait for the first one to fetch the temperatures
+    instead of all querying the controlmyspa API.
+    """
+    with _pool_lock:
+        return _fetch_pool()
+
+
+def current_hour() -> int:
+    """Return the current hour in Helsinki.
+
+    The Helsinki UTC offset is a whole number of hours, so the hour can only
+    change at a quarter-hour boundary and is only recomputed once per quarter.
+    """
+    global _hour_cache  # noqa: PLW0603
+    now = time.time()
+    bucket = int(now) // (15 * 60)
+    if bucket != _hour_cache[0]:
+        _hour_cache = (bucket, datetime.datetime.fromtimestamp(now, HELSINKI).hour)
+    return _hour_cache[1]
 
 
 def update_porssari():
@@ -130,23 +320,24 @@ def update_porssari():
     The configuration is cached in memory to be able to control the pool even if
     porssari.fi was temporarily offline
     """
-    with sentry_sdk.start_transaction(
-        op="task", name="Update Porssari"
-    ), APP.app_context():
+    with (
+        sentry_sdk.start_span(op="task", name="Update Porssari"),
+        APP.app_context(),
+    ):
+        # transport errors are retried by the SESSION adapter
         for attempt in tenacity.Retrying(
-            retry=(
-                tenacity.retry_if_exception_type(requests.exceptions.RequestException)
-                | tenacity.retry_if_exception_type(json.JSONDecodeError)
-            ),
+            # ValueError covers JSONDecodeError and UnicodeDecodeError of the raw
+            # response bytes
+            retry=tenacity.retry_if_exception_type(ValueError),
             wait=tenacity.wait_random_exponential(multiplier=1, max=60),
             stop=tenacity.stop_after_attempt(5),
             before_sleep=tenacity.before_sleep_log(APP.logger, logging.INFO),
         ):
             with attempt:
                 try:
-                    new_config = requests.get(
+                    new_config = SESSION.get(
                         PORSSARI_API,
-                        {
+                        params={
                             "device_mac": os.getenv("PORSSARI_MAC"),
                             "client": "controlmyspa-porssari-1",
                         },
@@ -154,121 +345,137 @@ def update_porssari():
                     )
                     """
                     2024-06-08: porssari started adding an extra newline before the JSON
-                    object, leading to JSON parse failure. stripping extra whitespace
-                    before JSON decoding here.
+                    object, leading to JSON parse failure. stripping leading whitespace
+                    before JSON decoding the raw response bytes here.
                     """
-                    global porssari_config  # noqa: PLW0603
-                    porssari_config = json.loads(new_config.text.strip())
-                    APP.logger.info("got porssari config: %s", porssari_config)
-                    # run the control loop once after we have a (new) config,
-                    # especially on startup
-                    scheduler.add_job(
-                        control,
-                        "date",
-                        run_date=datetime.datetime.now(),
-                    )
-                except json.JSONDecodeError as exception:
-                    APP.logger.info(
-                        "received from porssari: %s '%s'", new_config, new_config.text
+                    config = json.loads(new_config.content.lstrip())
+                    channel = (
+                        config.get("Channel1", {}) if isinstance(config, dict) else None
                     )
+                    if not isinstance(channel, dict):
+                        # valid JSON but not a porssari config, e.g. [] or null
+                        msg = f"unexpected porssari config: {config!r}"
+                        # ValueError so it is retried like a JSON parse error
+                        raise ValueError(msg)  # noqa: TRY004, TRY301
+                    # command "0" means low temp, "1" high temp
+                    hour_to_temp = [
+                        CONFIG["TEMP_LOW"]
+                        if channel.get(str(hour), "0") == "0"
+                        else CONFIG["TEMP_HIGH"]
+                        for hour in range(24)
+                    ]
+                    # only replace the previous config once the new one is usable
+                    global porssari_config, _HOUR_TO_TEMP  # noqa: PLW0603
+                    porssari_config = config
+                    _HOUR_TO_TEMP = hour_to_temp
+                    APP.logger.info("got porssari config: %s", porssari_config)
+                except ValueError as exception:
+                    # decoding the response text is not lazy, only do it when logged
+                    if APP.logger.isEnabledFor(logging.INFO):
+                        APP.logger.info(
+                            "received from porssari: %s '%s'",
+                            new_config,
+                            new_config.text,
+                        )
                     APP.logger.info("porssari fetch failed: %s", exception)
                     if not porssari_config:
-                        # retry in a minute if we don't have any config at all
-                        # else retry in the next normal 15m interval
-                        scheduler.add_job(
-                            update_porssari,
-                            "date",
-                            run_date=(
-                                datetime.datetime.now() + datetime.timedelta(minutes=1)
-                            ),
-                        )
+                        # retry a few times right away if we don't have any config
+                        # at all, control() schedules another try in a minute
+                        # after that. else retry in the next normal 15m interval
+                        raise
 
 
 def control():
-    """Set the pool temperature according to porssari instructions."""
+    """Fetch the porssari instructions and set the pool temperature accordingly."""
     with sentry_sdk.start_transaction(op="task", name="Update Controlmyspa"):
+        try:
+            update_porssari()
+        except (requests.exceptions.RequestException, tenacity.RetryError) as exception:
+            APP.logger.info(
+                "porssari fetch failed, using the previous config: %s", exception
+            )
+        except Exception:
+            # a broken fetch must not stop the temperature control of this run
+            APP.logger.exception(
+                "unexpected porssari fetch error, using the previous config"
+            )
         if not porssari_config:
             APP.logger.error("no porssari config present, not controlling")
+            # retry in a minute if we don't have any config at all
+            # else retry in the next normal 15m interval
+            scheduler.add_job(
+                control,
+                "date",
+                run_date=datetime.datetime.now(UTC) + datetime.timedelta(minutes=1),
+                id="control_retry",
+                replace_existing=True,
+            )
             return
-        current_hour = datetime.datetime.now(ZoneInfo("Europe/Helsinki")).hour
-        command = porssari_config.get("Channel1", {}).get(str(current_hour), "0")
-        if int(os.getenv("TEMP_OVERRIDE", "0")):
-            # if set, override temperature independent of hour control
-            set_temp(os.getenv("TEMP_OVERRIDE", "0"))
-        elif command == "0":
-            # low temp
-            set_temp(os.getenv("TEMP_LOW"))
-        else:
-            # command = "1"
-            # high temp
-            set_temp(os.getenv("TEMP_HIGH"))
+        # if set, override temperature independent of hour control
+        set_temp(CONFIG["TEMP_OVERRIDE"] or _HOUR_TO_TEMP[current_hour()])
 
 
 def set_temp(temp):
     """Update the pool temperature.
 
     Also fetch the current pool temperatures and cache them for 15 minutes.
+    While the target temperature does not change, the pool temperatures are only
+    re-read every POOL_REFRESH_INTERVAL, so manual overrides are detected within
+    two control runs instead of querying the API every time.
     """
+    global _last_commanded_temp, _last_pool, _last_pool_read  # noqa: PLW0603
+    global manual_override_endtime  # noqa: PLW0603
+    temp = int(temp)
     try:
-        for attempt in tenacity.Retrying(
-            retry=tenacity.retry_if_exception_type(
-                requests.exceptions.RequestException
-            ),
-            wait=tenacity.wait_random_exponential(multiplier=1, max=60),
-            stop=tenacity.stop_after_attempt(5),
-            before_sleep=tenacity.before_sleep_log(APP.logger, logging.INFO),
+        if (
+            temp != _last_commanded_temp
+            or _last_pool is None
+            or time.monotonic() - _last_pool_read >= POOL_REFRESH_INTERVAL
         ):
-            with attempt:
-                api = controlmyspa.ControlMySpa(
-                    os.getenv("CONTROLMYSPA_USER"), os.getenv("CONTROLMYSPA_PASS")
+            _last_pool = _with_retry(_refresh_pool)
+            _last_pool_read = time.monotonic()
+        pool = _last_pool
+        APP.logger.info(
+            "current temp: %s, desired temp: %s",
+            pool["current_temp"],
+            pool["desired_temp"],
+        )
+        desired_temp = int(pool["desired_temp"])
+        if desired_temp not in (CONFIG["TEMP_LOW"], CONFIG["TEMP_HIGH"]):
+            # somebody set a manual temperature through the pool controls
+            # let's disable porssari control for 12h
+            if manual_override_endtime > datetime.datetime.now(UTC):
+                # the end time is in the future -> let's wait
+                APP.logger.info(
+                    "not changing the temperature until %s due to manual override",
+                    manual_override_endtime,
                 )
-                pool = {
-                    "desired_temp": api.desired_temp,
-                    "current_temp": api.current_temp,
-                }
-                cache.set("pool", pool, timeout=15 * 60)
+                return
 
+            if manual_override_endtime == _EPOCH:
+                # end time not set -> this is the first detection
+                # of the manual override -> set the timer
+                manual_override_endtime = datetime.datetime.now(
+                    UTC
+                ) + datetime.timedelta(hours=12)
                 APP.logger.info(
-                    "current temp: %s, desired temp: %s",
-                    pool["current_temp"],
-                    pool["desired_temp"],
+                    "manual override detected, not changing the temperature until %s",
+                    manual_override_endtime,
                 )
-                if int(pool["desired_temp"]) != int(os.getenv("TEMP_HIGH")) and int(
-                    pool["desired_temp"]
-                ) != int(os.getenv("TEMP_LOW")):
-                    # somebody set a manual temperature through the pool controls
-                    # let's disable porssari control for 12h
-                    global manual_override_endtime
-                    if manual_override_endtime > datetime.datetime.now():
-                        # the end time is in the future -> let's wait
-                        APP.logger.info(
-                            "not changing the temperature until %s due to manual override",
-                            manual_override_endtime,
-                        )
-                        return
+                return
 
-                    if manual_override_endtime == datetime.datetime.fromtimestamp(0):
-                        # end time not set -> this is the first detection
-                        # of the manual override -> set the timer
-                        manual_override_endtime = (
-                            datetime.datetime.now() + datetime.timedelta(hours=12)
-                        )
-                        APP.logger.info(
-                            "manual override detected, not changing the temperature until %s",
-                            manual_override_endtime,
-                        )
-                        return
-
-                    # the manual override time expired
-                    # reset the timer for the next override
-                    manual_override_endtime = datetime.datetime.fromtimestamp(0)
-                    # take control over the temperature below
-
-                if pool["desired_temp"] != int(temp):
-                    api.desired_temp = int(temp)
-                    APP.logger.info("set desired temp %s", temp)
-                else:
-                    APP.logger.info("not changing desired temp %s", temp)
+            # the manual override time expired
+            # reset the timer for the next override
+            manual_override_endtime = _EPOCH
+            # take control over the temperature below
+
+        if pool["desired_temp"] != temp:
+            _last_pool = _with_retry(_write_desired_temp, temp)
+            _last_pool_read = time.monotonic()
+            APP.logger.info("set desired temp %s", temp)
+        else:
+            APP.logger.info("not changing desired temp %s", temp)
+        _last_commanded_temp = temp
     except tenacity.RetryError as exception:
         APP.logger.info(
             "ignoring controlmyspa API error, retrying next control loop: %s",
@@ -279,44 +486,41 @@ def set_temp(temp):
 @APP.route("/")
 def status():
     """WebGUI to show current porssari configuration and (cached) pool temperatures."""
-    pool = cache.get("pool")
-    if pool is None:
-        try:
-            for attempt in tenacity.Retrying(
-                retry=tenacity.retry_if_exception_type(
-                    requests.exceptions.RequestException
-                ),
-                wait=tenacity.wait_random_exponential(multiplier=1, max=60),
-                stop=tenacity.stop_after_attempt(5),
-                before_sleep=tenacity.before_sleep_log(APP.logger, logging.INFO),
-            ):
-                with attempt:
-                    api = controlmyspa.ControlMySpa(
-                        os.getenv("CONTROLMYSPA_USER"), os.getenv("CONTROLMYSPA_PASS")
-                    )
-                    pool = {
-                        "desired_temp": api.desired_temp,
-                        "current_temp": api.current_temp,
-                    }
-                    cache.set("pool", pool, timeout=15 * 60)
-        except tenacity.RetryError:
-            pool = None
+    try:
+        pool = _with_retry(get_pool)
+    except tenacity.RetryError:
+        pool = None
     return flask.render_template(
         "index.html",
-        porssari_config=porssari_config,
-        current_hour=datetime.datetime.now(ZoneInfo("Europe/Helsinki")).hour,
+        hours=list(porssari_config.get("Channel1", {}).items()),
+        current_hour=str(current_hour()),
         api=pool,
-        manual_override_endtime=manual_override_endtime,
+        # shown in local time, None when no manual override was detected
+        manual_override_endtime=(
+            None
+            if manual_override_endtime == _EPOCH
+            else manual_override_endtime.astimezone(HELSINKI)
+        ),
     )
 
 
+def traces_sampler(sampling_context: dict) -> float:
+    """Sample only a few of the scheduled background tasks for tracing.
+
+    Errors are still reported for every run, this only limits the performance
+    tracing overhead of the 15 minute jobs.
+    """
+    if sampling_context["transaction_context"].get("op") == "task":
+        return 0.05
+    return 0.8
+
+
 if __name__ == "__main__":
-    load_dotenv()
     sentry_sdk.init(
         os.environ.get("SENTRY_URL"),
         integrations=[FlaskIntegration()],
         enable_tracing=True,
-        traces_sample_rate=0.8,
+        traces_sampler=traces_sampler,
     )
     initialize()
     APP.wsgi_app = ProxyFix(APP.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)